@@ -1,14 +1,46 @@
 from fastapi import FastAPI, UploadFile, File, Form, HTTPException
-from fastapi.responses import StreamingResponse
+from fastapi.responses import Response, FileResponse
 from fastapi.middleware.cors import CORSMiddleware
-import pandas as pd
-import io
-import json
-from openpyxl import Workbook
-from openpyxl.styles import PatternFill, Font, Alignment, Border, Side
+from starlette.background import BackgroundTask
+import numpy as np
+import asyncio
+import os
+import orjson
+import tempfile
+import time
+import uuid
+from copy import copy
+import hashlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+from openpyxl import Workbook, load_workbook
+from openpyxl.styles import PatternFill, Font, Alignment, Border, Side, NamedStyle
+from openpyxl.styles.fonts import DEFAULT_FONT
+from openpyxl.cell import WriteOnlyCell
 from openpyxl.utils import get_column_letter
 
-app = FastAPI(title="Garment Auto Balancer – Dynamic Core")
+try:
+    import pyopenxlsx # Optional C++-backed xlsx writer, used by generate_excel_report when installed
+except ImportError:
+    pyopenxlsx = None
+
+try:
+    from numba import njit
+except ImportError: # Numba is optional: fall back to plain Python (same results, just slower)
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda func: func
+
+class ORJSONResponse(Response):
+    # JSON via orjson: serialises the large /balance payload in C (and accepts NumPy scalars)
+    media_type = "application/json"
+
+    def render(self, content):
+        return orjson.dumps(content, option=orjson.OPT_SERIALIZE_NUMPY)
+
+app = FastAPI(title="Garment Auto Balancer – Dynamic Core", default_response_class=ORJSONResponse)
 
 app.add_middleware(
     CORSMiddleware, 
@@ -23,232 +55,576 @@ def health_check():
     return {"status": "ok", "message": "Garment Balancer Backend is Ready 🚀"}
 
 # --- CORE ALGORITHM (Your Logic) ---
-def true_thai_balancing(processes, num_operators, time_key="smv"):
-    """ 
-    Line Balancing (Sequential Flow / Water Flow)
-    Updated: Uses 'time_key' to decide if we balance based on SMV or CT
+@njit(nogil=True, cache=True) # nogil: sections can be balanced in parallel threads
+def _balance_core(times, num_operators):
     """
-    if num_operators <= 0:
-        return []
+    Numeric part of true_thai_balancing, compiled with Numba when available.
+    Returns one entry per task fragment: (proc_idx, op_idx, take_time) plus
+    each operator's total time and the number of fragments produced.
+    """
+    total_time = 0.0
+    for t in times:
+        total_time += t
+    target_ct = total_time / num_operators
+
+    # Every fragment after a process's first one moves to the next operator,
+    # so there can never be more than (processes + operators) fragments.
+    max_frags = len(times) + num_operators
+    proc_idx = np.empty(max_frags, dtype=np.int64)
+    op_idx = np.empty(max_frags, dtype=np.int32)
+    take_times = np.empty(max_frags, dtype=np.float64)
+    op_sec = np.zeros(num_operators, dtype=np.float64)
+    count = 0
 
-    # Calculate Target Cycle Time (Takt Time) based on SELECTED time
-    total_time = sum(p[time_key] for p in processes)
-    target_ct = total_time / num_operators if num_operators > 0 else 0
-    
-    operators = [{"op": i+1, "sec": 0.0, "tasks": []} for i in range(num_operators)] # Store op as INT index first
-    
     current_op_idx = 0
-    
-    for proc in processes:
-        remaining_proc_time = proc[time_key] # Use dynamic key
-        proc_no = proc["no"]
-        proc_desc = proc["desc"]
-        original_time = proc[time_key] # Use dynamic key
+    last_op = num_operators - 1
+
+    for p in range(len(times)):
+        remaining_proc_time = times[p]
+        if remaining_proc_time <= 0.001:
+            continue
+
+        # Skip operators that are already full (or overfilled slightly)
+        while current_op_idx < last_op and target_ct - op_sec[current_op_idx] <= 0.001:
+            current_op_idx += 1
+
+        # Fast path: the whole process fits in the current operator
+        if remaining_proc_time <= target_ct - op_sec[current_op_idx]:
+            proc_idx[count] = p
+            op_idx[count] = current_op_idx
+            take_times[count] = remaining_proc_time
+            count += 1
+            op_sec[current_op_idx] += remaining_proc_time
+            continue
 
         # Keep distributing this process until it's finished
         while remaining_proc_time > 0.001:
-            
-            # Safety: If we run out of operators, dump everything to the last one
-            if current_op_idx >= num_operators:
-                current_op_idx = num_operators - 1
-            
-            current_op = operators[current_op_idx]
-            
-            # How much space is left for this operator?
-            space_left = target_ct - current_op["sec"]
-            
-            # If this operator is already full (or overfilled slightly), move to next
-            if space_left <= 0.001:
+
+            # Skip operators that are already full (or overfilled slightly)
+            while current_op_idx < last_op and target_ct - op_sec[current_op_idx] <= 0.001:
                 current_op_idx += 1
-                continue
-            
+
+            # How much space is left for this operator?
+            space_left = target_ct - op_sec[current_op_idx]
+
             # Determine how much this operator can take
-            take_time = min(remaining_proc_time, space_left)
-            
-            # Calculate Percentage for display
-            percentage = (take_time / original_time) * 100 if original_time > 0 else 0
-            
+            # Safety: If we run out of operators, dump everything to the last one
+            if current_op_idx == last_op and remaining_proc_time - space_left > 0.001:
+                take_time = remaining_proc_time
+            else:
+                take_time = min(remaining_proc_time, space_left)
+
+            proc_idx[count] = p
+            op_idx[count] = current_op_idx
+            take_times[count] = take_time
+            count += 1
+
+            # Update counters
+            op_sec[current_op_idx] += take_time
+            remaining_proc_time -= take_time
+
+            # If we just filled this operator perfectly (or close to it),
+            # and there is still work left in this process, move to next operator
+            if remaining_proc_time > 0.001 and current_op_idx < last_op:
+                current_op_idx += 1
+
+    return proc_idx, op_idx, take_times, op_sec, count
+
+# Compile (or load from Numba's on-disk cache) at worker start-up rather than on the
+# first /balance request. Parsed sections pass read-only arrays, so warm up with one.
+_warmup_times = np.ones(1)
+_warmup_times.flags.writeable = False
+_balance_core(_warmup_times, 1)
+del _warmup_times
+
+def true_thai_balancing(processes, num_operators, time_key="smv", build_desc=True):
+    """ 
+    Line Balancing (Sequential Flow / Water Flow) of one section on 'time_key' (SMV or CT).
+    Returns (operators, op_sec): the operator dicts and each operator's total time.
+    build_desc=False leaves "desc"/"percentage" out of the tasks.
+    """
+    if num_operators <= 0:
+        return [], np.zeros(0)
+
+    # Balance on the SELECTED time; Target Cycle Time (Takt Time) is computed in the core
+    times = processes[time_key]
+    proc_idx, op_idx, take_times, op_sec, count = _balance_core(times, num_operators)
+    
+    # The core fills operators strictly in order, so each operator's fragments are
+    # contiguous: build them all into one preallocated list and slice it per operator.
+    nos = processes["no"].tolist()
+    fragments = zip(proc_idx[:count].tolist(), take_times[:count].tolist())
+
+    if not build_desc:
+        tasks = [{"no": nos[p], "time": take_time} for p, take_time in fragments]
+    else:
+        tasks = [None] * count
+        original_times = times.tolist()
+        descs = processes["desc"]
+        parts = processes["part"]
+
+        for k, (p, take_time) in enumerate(fragments):
+            proc_no = nos[p]
+            original_time = original_times[p]
+
+            # Calculate Percentage for display (whole processes need no division)
+            if take_time == original_time:
+                percentage = 100.0
+            else:
+                percentage = (take_time / original_time) * 100 if original_time > 0 else 0
+        
             # Format Description
-            part_str = f' - "{proc["part"]}"' if proc.get("part") else ""
-            task_desc = f"No.{proc_no}: {proc_desc}"
+            part_str = f' - "{parts[p]}"' if parts[p] else ""
+            task_desc = f"No.{proc_no}: {descs[p]}"
             if percentage < 99.9:
                 task_desc += f" ({percentage:.0f}%)"
-            
+        
             # Append Part at the very end
             task_desc += part_str
-            
-            # Add task to operator
-            current_op["tasks"].append({
+        
+            tasks[k] = {
                 "no": proc_no,
                 "desc": task_desc,
                 "time": take_time,
                 "percentage": percentage
-            })
-            
-            # Update counters
-            current_op["sec"] += take_time
-            remaining_proc_time -= take_time
-            
-            # If we just filled this operator perfectly (or close to it), 
-            # and there is still work left in this process, move to next operator
-            if remaining_proc_time > 0.001:
-                current_op_idx += 1
+            }
+
+    # Add tasks to operators
+    bounds = [0] + np.cumsum(np.bincount(op_idx[:count], minlength=num_operators)).tolist()
+    operators = [
+        {"op": i+1, "sec": sec, "tasks": tasks[bounds[i]:bounds[i+1]]} # INT op index; /balance formats it as "Op N"
+        for i, sec in enumerate(op_sec.tolist())
+    ]
+    op_sec.flags.writeable = False # Shared through the balance cache
+
+    return operators, op_sec
+
+# Sections are independent, so large reports balance them on a shared pool
+# (the compiled core releases the GIL). Small reports stay sequential, where
+# the pool's hand-off would cost more than it saves.
+PARALLEL_MIN_SECTIONS = 8
+_balance_pool = ThreadPoolExecutor(max_workers=os.cpu_count(), thread_name_prefix="balance")
+
+def balance_sections(sections_data, config, time_mode, build_desc=True):
+    """
+    Runs true_thai_balancing for every section, in sheet order.
+    'config' maps section name -> number of operators (default 1).
+    """
+    names = list(sections_data)
+    nums_ops = [int(config.get(sec_name, 1)) for sec_name in names]
+    args = (sections_data.values(), nums_ops, [time_mode] * len(names), [build_desc] * len(names))
+    if len(names) >= PARALLEL_MIN_SECTIONS:
+        results = _balance_pool.map(true_thai_balancing, *args) # map() keeps sheet order
+    else:
+        results = map(true_thai_balancing, *args)
 
-    return operators
+    balanced = []
+    for sec_name, num_ops, (operators, op_sec) in zip(names, nums_ops, results):
+        balanced.append({
+            "name": sec_name,
+            "num_ops": num_ops,
+            "operators": operators,
+            "op_sec": op_sec # operators[i]["sec"] as an array
+        })
+    return balanced
+
+SECTION_COLUMNS = ("no", "desc", "flow", "mc", "smv", "ct", "part")
+
+def to_number(value):
+    """
+    Cell value -> float, or None if it is not a number (like pd.to_numeric(errors='coerce')).
+    openpyxl already gives native int/float, so text is only parsed as a fallback.
+    """
+    if isinstance(value, (int, float)):
+        num = float(value)
+    elif isinstance(value, str):
+        try:
+            num = float(value)
+        except ValueError:
+            return None
+    else:
+        return None
+    return num if num == num else None # NaN check
 
-async def parse_excel_structure(file_content):
+def parse_excel_structure(file_obj):
     """
-    Reads Excel and returns an ORDERED dictionary.
-    Updated: Reads Col G (Index 6) as SMV, Col H (Index 7) as CT, Col I (Index 8) as Part.
+    Reads the PA sheet into an ORDERED dictionary of sections (Col G = SMV, Col H = CT, Col I = Part).
+    Each section holds its columns ("no"/"smv"/"ct" as NumPy arrays, text columns as tuples)
+    plus "smv_total"/"ct_total". Blocking, so endpoints call it through get_sections().
     """
     try:
-        df = pd.read_excel(io.BytesIO(file_content), sheet_name="PA sheet", header=None, engine='openpyxl')
+        file_obj.seek(0)
+        wb = load_workbook(file_obj, read_only=True, data_only=True)
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Error reading Excel: {str(e)}")
 
-    sections = {} # Use dict to keep insertion order
-    
-    # Start from Row 5 (Index 4)
-    for i in range(4, df.shape[0]):
-        row = df.iloc[i]
-        try:
-            # Column G (Index 6) is SMV Time
-            smv_val = pd.to_numeric(row.iloc[6], errors='coerce')
-            if pd.isna(smv_val) or smv_val <= 0: continue
-            
-            # NEW: Column H (Index 7) is CT Time (formerly NGIE)
-            # If CT is blank or 0, we fallback to SMV value
-            ct_val = pd.to_numeric(row.iloc[7], errors='coerce')
-            if pd.isna(ct_val) or ct_val <= 0:
-                ct_val = 0 # Explicitly 0 if missing, don't fallback to SMV unless logic requires (User said summary box should be zero if missing)
-            
-            # NEW: Column I (Index 8) is Part Name
-            part_name = str(row.iloc[8]).strip() if pd.notna(row.iloc[8]) else ""
+    try:
+        if "PA sheet" not in wb.sheetnames:
+            raise HTTPException(status_code=400, detail="Error reading Excel: Worksheet named 'PA sheet' not found")
+        ws = wb["PA sheet"]
+
+        section_rows = {} # Use dict to keep insertion order; section -> [row tuple, ...]
+
+        # Start from Row 5 (Index 4), Columns A..I
+        for i, row in enumerate(ws.iter_rows(min_row=5, max_col=9, values_only=True), start=4):
+            try:
+                _, no, sec, flow, mc, desc, smv, ct, part = row
+
+                # Column G (Index 6) is SMV Time
+                smv_val = to_number(smv)
+                if smv_val is None or smv_val <= 0: continue
+
+                # NEW: Column H (Index 7) is CT Time (formerly NGIE)
+                # If CT is blank or 0, we fallback to SMV value
+                ct_val = to_number(ct)
+                if ct_val is None or ct_val <= 0:
+                    ct_val = 0 # Explicitly 0 if missing, don't fallback to SMV unless logic requires (User said summary box should be zero if missing)
+
+                # NEW: Column I (Index 8) is Part Name
+                part_name = str(part).strip() if part is not None else ""
+
+                # Column C (Index 2) is Section Name
+                raw_sec_name = str(sec).strip() if sec is not None else ""
+                if not raw_sec_name: continue
+
+                # Store both time values + Flow/MC for Export (in SECTION_COLUMNS order)
+                proc = (
+                    int(no) if no is not None else i,
+                    str(desc).strip() if desc is not None else "",
+                    str(flow) if flow is not None else "", # Captured for Export
+                    str(mc) if mc is not None else "",     # Captured for Export
+                    smv_val,
+                    float(ct_val),
+                    part_name
+                )
+
+                if raw_sec_name not in section_rows:
+                    section_rows[raw_sec_name] = []
+
+                section_rows[raw_sec_name].append(proc)
+
+            except Exception:
+                continue
+    finally:
+        wb.close()
+
+    # Transpose each section's rows into columns in one go. Parsed sections are shared
+    # via the cache, so every column is immutable: tuples, and read-only arrays for numbers.
+    sections = {}
+    for sec_name, rows in section_rows.items():
+        columns = dict(zip(SECTION_COLUMNS, zip(*rows)))
+        for key, dtype in (("no", np.int64), ("smv", np.float64), ("ct", np.float64)):
+            columns[key] = np.array(columns[key], dtype=dtype)
+            columns[key].flags.writeable = False
+        columns["smv_total"] = float(columns["smv"].sum())
+        columns["ct_total"] = float(columns["ct"].sum())
+        sections[sec_name] = columns
 
-            # Column C (Index 2) is Section Name
-            raw_sec_name = str(row.iloc[2]).strip()
-            if not raw_sec_name or raw_sec_name.lower() == 'nan': continue
-            
-            # Store both time values + Flow/MC for Export
-            proc = {
-                "no": int(row.iloc[1]) if pd.notna(row.iloc[1]) else i,
-                "desc": str(row.iloc[5]).strip(),
-                "flow": str(row.iloc[3]) if pd.notna(row.iloc[3]) else "", # Captured for Export
-                "mc": str(row.iloc[4]) if pd.notna(row.iloc[4]) else "",   # Captured for Export
-                "smv": float(smv_val),
-                "ct": float(ct_val),
-                "part": part_name
-            }
-            
-            if raw_sec_name not in sections:
-                sections[raw_sec_name] = []
-            
-            sections[raw_sec_name].append(proc)
-            
-        except Exception:
-            continue
-            
     return sections
 
+# --- RESULT CACHES ---
+# The same upload is sent to /analyze, /balance and /export, so keep parsed sections
+# (keyed by a hash of the file contents) and balancing results (keyed by file hash +
+# config + time mode). Cached values are shared between requests: treat them as read-only.
+PARSE_CACHE_SIZE = 32
+BALANCE_CACHE_SIZE = 32
+_parse_cache = OrderedDict()   # Map: sha1(file) -> sections
+_balance_cache = OrderedDict() # Map: (sha1(file), config_str, time_mode[, "no_desc"]) -> balance_sections() result
+UPLOAD_HASH_CHUNK = 64 * 1024
+
+def upload_key(file_obj):
+    # Hash in chunks so the upload is never held in memory as one bytes object
+    digest = hashlib.sha1()
+    file_obj.seek(0)
+    while chunk := file_obj.read(UPLOAD_HASH_CHUNK):
+        digest.update(chunk)
+    file_obj.seek(0)
+    return digest.digest()
+
+def cache_get(cache, key):
+    value = cache.get(key)
+    if value is not None:
+        cache.move_to_end(key)
+    return value
+
+def cache_put(cache, key, value, max_size):
+    cache[key] = value
+    cache.move_to_end(key)
+    if len(cache) > max_size:
+        cache.popitem(last=False) # Drop least recently used
+
+async def get_sections(file_obj, key):
+    sections = cache_get(_parse_cache, key)
+    if sections is None:
+        sections = await asyncio.to_thread(parse_excel_structure, file_obj)
+        cache_put(_parse_cache, key, sections, PARSE_CACHE_SIZE)
+    return sections
+
+async def parse_upload(file):
+    """
+    Returns (file_key, sections) for an UploadFile. Hashes and parses straight
+    from its spooled temp file (UploadFile.file) instead of `await file.read()`.
+    """
+    file_key = await asyncio.to_thread(upload_key, file.file)
+    return file_key, await get_sections(file.file, file_key)
+
+async def get_balanced_sections(sections_data, config, time_mode, key, build_desc=True):
+    # Full results (with task descriptions) also serve build_desc=False callers;
+    # results built without them are kept under their own key.
+    balanced = cache_get(_balance_cache, key)
+    if balanced is None and not build_desc:
+        key = (*key, "no_desc")
+        balanced = cache_get(_balance_cache, key)
+    if balanced is None:
+        balanced = await asyncio.to_thread(balance_sections, sections_data, config, time_mode, build_desc)
+        cache_put(_balance_cache, key, balanced, BALANCE_CACHE_SIZE)
+    return balanced
+
+# --- SESSIONS ---
+# /analyze hands back a token for the parsed upload so /balance and /export can
+# send the token instead of re-uploading the same file.
+SESSION_TTL = 10 * 60 # Seconds since last use
+SESSION_STORE_SIZE = 64
+_session_store = OrderedDict() # Map: token -> (expires_at, sha1(file), sections), least recently used first
+
+def create_session(file_key, sections):
+    now = time.monotonic()
+    # Expired tokens are the least recently used, so they sit at the front
+    while _session_store and next(iter(_session_store.values()))[0] <= now:
+        _session_store.popitem(last=False)
+
+    token = uuid.uuid4().hex
+    cache_put(_session_store, token, (now + SESSION_TTL, file_key, sections), SESSION_STORE_SIZE)
+    return token
+
+async def load_sections(file, token):
+    """
+    Returns (file_key, sections) for a request that sent either a session token
+    from /analyze or the Excel file itself (used if the token is missing/expired).
+    """
+    if token:
+        session = _session_store.get(token)
+        now = time.monotonic()
+        if session is not None and session[0] > now:
+            _, file_key, sections = session
+            cache_put(_session_store, token, (now + SESSION_TTL, file_key, sections), SESSION_STORE_SIZE)
+            return file_key, sections
+
+    if file is None:
+        detail = "Session expired, please upload the file again" if token else "No file uploaded"
+        raise HTTPException(status_code=400, detail=detail)
+
+    return await parse_upload(file)
+
 # --- NEW: EXCEL GENERATION LOGIC ---
-def generate_excel_report(sections_data, balanced_data_list):
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "Balancing Report"
-    
-    # Styles
-    header_fill = PatternFill(start_color="36454F", end_color="36454F", fill_type="solid") # Dark Gray
-    section_fill = PatternFill(start_color="D3D3D3", end_color="D3D3D3", fill_type="solid") # Light Gray
-    header_font = Font(color="FFFFFF", bold=True)
-    center_align = Alignment(horizontal="center", vertical="center")
-    thin_border = Border(left=Side(style='thin'), right=Side(style='thin'), top=Side(style='thin'), bottom=Side(style='thin'))
+# Set USE_NATIVE_WRITER=0 to force the openpyxl writer even when pyopenxlsx is installed
+USE_NATIVE_WRITER = os.environ.get("USE_NATIVE_WRITER", "1") == "1"
 
-    # 1. Setup Static Headers (Row 5)
-    static_headers = ["No", "PPA", "Flow", "MC", "Process", "SMV", "CT", "Part"]
-    for col_num, header in enumerate(static_headers, 1):
-        cell = ws.cell(row=5, column=col_num, value=header)
-        cell.fill = header_fill
-        cell.font = header_font
-        cell.alignment = center_align
-        cell.border = thin_border
+STATIC_HEADERS = ["No", "PPA", "Flow", "MC", "Process", "SMV", "CT", "Part"]
+FIRST_OP_COL = 9 # Operator columns start after Part (Col I is 8)
 
-    # 2. Setup Dynamic Operator Headers (Row 4 & 5)
-    current_col = 9 # Starts after Part (Col I is 8)
-    
-    op_task_map = {} # Map: task_no -> { global_col_index: time }
+def build_report_layout(balanced_data_list):
+    """
+    Gives every operator its own global column, section by section.
+    Returns (section_spans, op_task_map, current_col):
+      section_spans: [(sec_name, start_col, num_ops)] for sections with operators
+      op_task_map:   task_no -> [(global_col_index, time), ...]
+      current_col:   first column after the last operator
+    """
+    section_spans = []
+    op_task_map = {}
+    current_col = FIRST_OP_COL
 
     for sec_data in balanced_data_list:
-        sec_name = sec_data['name']
         ops = sec_data['operators']
         num_ops = len(ops)
-        
-        # Merge Header for Section (Row 4)
         if num_ops > 0:
-            start_col = current_col
-            end_col = current_col + num_ops - 1
-            ws.merge_cells(start_row=4, start_column=start_col, end_row=4, end_column=end_col)
-            sec_cell = ws.cell(row=4, column=start_col, value=sec_name)
-            sec_cell.alignment = center_align
-            sec_cell.font = Font(bold=True)
-            sec_cell.fill = section_fill
+            section_spans.append((sec_data['name'], current_col, num_ops))
             
-            # Operator Headers (Row 5)
-            # Reset numbering for each section (Op 1, Op 2...)
+            # Map tasks for each operator to the global column index
             for i, op in enumerate(ops):
-                col_idx = current_col + i
-                cell = ws.cell(row=5, column=col_idx, value=f"Op {i+1}")
-                cell.alignment = center_align
-                cell.border = thin_border
-                cell.font = Font(bold=True)
-                
-                # Map tasks for this operator to the global column index
                 for task in op['tasks']:
-                    t_no = task['no']
-                    if t_no not in op_task_map: op_task_map[t_no] = {}
-                    op_task_map[t_no][col_idx] = task['time']
+                    op_task_map.setdefault(task['no'], []).append((current_col + i, task['time']))
             
             current_col += num_ops
 
-    # 3. Fill Data Rows (Using original sequential order)
-    current_row = 6
+    return section_spans, op_task_map, current_col
+
+def iter_report_rows(sections_data):
+    # Static columns of each data row, in original sequential order
     for sec_name, procs in sections_data.items():
-        for proc in procs:
-            # Static Data
-            ws.cell(row=current_row, column=1, value=proc['no']).border = thin_border
-            ws.cell(row=current_row, column=2, value=sec_name).border = thin_border
-            ws.cell(row=current_row, column=3, value=proc['flow']).border = thin_border
-            ws.cell(row=current_row, column=4, value=proc['mc']).border = thin_border
-            ws.cell(row=current_row, column=5, value=proc['desc']).border = thin_border
-            ws.cell(row=current_row, column=6, value=proc['smv']).border = thin_border
-            ws.cell(row=current_row, column=7, value=proc['ct']).border = thin_border
-            ws.cell(row=current_row, column=8, value=proc['part']).border = thin_border
-            
-            # Dynamic Operator Data
-            assignments = op_task_map.get(proc['no'], {})
-            
-            # Iterate through all operator columns created
-            total_cols = current_col - 1
-            for col_idx in range(9, total_cols + 1):
-                cell = ws.cell(row=current_row, column=col_idx)
-                cell.border = thin_border
-                if col_idx in assignments:
-                    cell.value = assignments[col_idx]
-                    cell.alignment = center_align
-                    # Highlight split tasks (red text)
-                    if len(assignments) > 1:
-                        cell.font = Font(color="FF0000") 
-            
-            current_row += 1
+        yield from zip(
+            procs['no'].tolist(), [sec_name] * len(procs['desc']), procs['flow'], procs['mc'], procs['desc'],
+            procs['smv'].tolist(), procs['ct'].tolist(), procs['part']
+        )
+
+def generate_excel_report(sections_data, balanced_data_list):
+    """
+    Builds the balancing report workbook in a temp .xlsx file.
+    Returns the file path; the caller must unlink it once sent.
+    """
+    layout = build_report_layout(balanced_data_list)
+    writer = write_report_native if pyopenxlsx is not None and USE_NATIVE_WRITER else write_report_openpyxl
+    fd, path = tempfile.mkstemp(suffix=".xlsx")
+    os.close(fd)
+    try:
+        writer(path, sections_data, *layout)
+    except:
+        os.unlink(path)
+        raise
+    return path
+
+# openpyxl Styles (immutable, shared by every report)
+HEADER_FILL = PatternFill(start_color="36454F", end_color="36454F", fill_type="solid") # Dark Gray
+SECTION_FILL = PatternFill(start_color="D3D3D3", end_color="D3D3D3", fill_type="solid") # Light Gray
+HEADER_FONT = Font(color="FFFFFF", bold=True)
+BOLD_FONT = Font(bold=True)
+RED_FONT = Font(color="FF0000")
+CENTER_ALIGN = Alignment(horizontal="center", vertical="center")
+THIN_BORDER = Border(left=Side(style='thin'), right=Side(style='thin'), top=Side(style='thin'), bottom=Side(style='thin'))
+
+def write_report_openpyxl(path, sections_data, section_spans, op_task_map, current_col):
+    # Write-only mode streams rows to disk instead of keeping every Cell in memory,
+    # so rows must be appended in order (Row 1 -> last data row).
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Balancing Report")
+
+    def styled_cell(value=None, fill=None, font=None, alignment=None, border=None):
+        cell = WriteOnlyCell(ws, value=value)
+        if fill: cell.fill = fill
+        if font: cell.font = font
+        if alignment: cell.alignment = alignment
+        if border: cell.border = border
+        return cell
+
+    # Data cells use named styles registered once on the workbook, so each
+    # cell carries a single style reference instead of per-cell border/font objects.
+    # (NamedStyles bind to their workbook, so these are built per report.)
+    for style in (
+        NamedStyle(name="bordered", font=copy(DEFAULT_FONT), border=THIN_BORDER),
+        NamedStyle(name="bordered_center", font=copy(DEFAULT_FONT), alignment=CENTER_ALIGN, border=THIN_BORDER),
+        NamedStyle(name="bordered_center_red", font=RED_FONT, alignment=CENTER_ALIGN, border=THIN_BORDER), # Split task
+    ):
+        wb.add_named_style(style)
+
+    def named_cell(value, style):
+        cell = WriteOnlyCell(ws, value=value)
+        cell.style = style
+        return cell
+
+    # 1. Setup Static Headers (Row 5)
+    section_row = [None] * len(STATIC_HEADERS) # Row 4
+    header_row = [styled_cell(header, HEADER_FILL, HEADER_FONT, CENTER_ALIGN, THIN_BORDER) for header in STATIC_HEADERS]
 
-    # Adjust Column Widths
+    # 2. Setup Dynamic Operator Headers (Row 4 & 5)
+    for sec_name, start_col, num_ops in section_spans:
+        # Merge Header for Section (Row 4)
+        end_col = start_col + num_ops - 1
+        ws.merged_cells.add(f"{get_column_letter(start_col)}4:{get_column_letter(end_col)}4")
+        section_row.append(styled_cell(sec_name, SECTION_FILL, BOLD_FONT, CENTER_ALIGN))
+        section_row.extend([None] * (num_ops - 1))
+        
+        # Operator Headers (Row 5)
+        # Reset numbering for each section (Op 1, Op 2...)
+        for i in range(num_ops):
+            header_row.append(styled_cell(f"Op {i+1}", font=BOLD_FONT, alignment=CENTER_ALIGN, border=THIN_BORDER))
+
+    # Adjust Column Widths (must be set before the first row is written)
     ws.column_dimensions['E'].width = 40 # Process Desc
     for col in range(8, current_col):
         ws.column_dimensions[get_column_letter(col)].width = 8
 
-    stream = io.BytesIO()
-    wb.save(stream)
-    stream.seek(0)
-    return stream
+    for _ in range(3): # Rows 1-3 are left blank
+        ws.append([])
+    ws.append(section_row)
+    ws.append(header_row)
+
+    # 3. Fill Data Rows (Using original sequential order)
+    # Empty operator cells all share one bordered cell; append() re-positions it per column.
+    num_op_cols = current_col - FIRST_OP_COL
+    blank_cell = named_cell(None, "bordered")
+    for static_values in iter_report_rows(sections_data):
+        # Static Data
+        row = [named_cell(value, "bordered") for value in static_values]
+        
+        # Dynamic Operator Data: only visit the operators this process was assigned to
+        assignments = op_task_map.get(static_values[0], [])
+        op_cells = [blank_cell] * num_op_cols
+        
+        # Highlight split tasks (red text)
+        style = "bordered_center_red" if len(assignments) > 1 else "bordered_center"
+        for col_idx, task_time in assignments:
+            op_cells[col_idx - FIRST_OP_COL] = named_cell(task_time, style)
+        
+        row.extend(op_cells)
+        ws.append(row)
+
+    wb.save(path)
+
+def write_report_native(path, sections_data, section_spans, op_task_map, current_col):
+    # Same sheet as write_report_openpyxl, written through pyopenxlsx's C++ core.
+    px = pyopenxlsx
+    wb = px.Workbook()
+    try:
+        ws = wb.active
+        ws.title = "Balancing Report"
+
+        # Styles (registered once, referenced by index)
+        thin = px.Side(style="thin")
+        thin_border = px.Border(left=thin, right=thin, top=thin, bottom=thin)
+        center_align = px.Alignment(horizontal="center", vertical="center")
+        header_style = wb.add_style(
+            font=px.Font(name="Calibri", bold=True, color="FFFFFF"),
+            fill=px.Fill(pattern_type="solid", color="36454F"), # Dark Gray
+            border=thin_border, alignment=center_align
+        )
+        section_style = wb.add_style(
+            font=px.Font(name="Calibri", bold=True),
+            fill=px.Fill(pattern_type="solid", color="D3D3D3"), # Light Gray
+            alignment=center_align
+        )
+        op_header_style = wb.add_style(font=px.Font(name="Calibri", bold=True), border=thin_border, alignment=center_align)
+        bordered = wb.add_style(font=px.Font(name="Calibri"), border=thin_border)
+        task_style = wb.add_style(font=px.Font(name="Calibri"), border=thin_border, alignment=center_align)
+        split_task_style = wb.add_style(font=px.Font(name="Calibri", color="FF0000"), border=thin_border, alignment=center_align)
+
+        # 1. Static Headers (Row 5)
+        for col, header in enumerate(STATIC_HEADERS, 1):
+            ws.cell(5, col, header).style_index = header_style
+
+        # 2. Section (Row 4) & Operator (Row 5) Headers
+        for sec_name, start_col, num_ops in section_spans:
+            if num_ops > 1: # pyopenxlsx rejects single-cell merges
+                ws.merge_cells(f"{get_column_letter(start_col)}4:{get_column_letter(start_col + num_ops - 1)}4")
+            ws.cell(4, start_col, sec_name).style_index = section_style
+            for i in range(num_ops):
+                ws.cell(5, start_col + i, f"Op {i+1}").style_index = op_header_style
+
+        # 3. Data Rows
+        op_cols = range(FIRST_OP_COL, current_col)
+        row_num = 6
+        for static_values in iter_report_rows(sections_data):
+            ws.write_row(row_num, [None if value == "" else value for value in static_values]) # Leave blanks empty, like openpyxl
+            for col in range(1, FIRST_OP_COL):
+                ws.cell(row_num, col).style_index = bordered
+
+            assignments = op_task_map.get(static_values[0], [])
+            for col in op_cols:
+                ws.cell(row_num, col).style_index = bordered
+            style = split_task_style if len(assignments) > 1 else task_style # Highlight split tasks (red text)
+            for col_idx, task_time in assignments:
+                cell = ws.cell(row_num, col_idx, task_time)
+                cell.style_index = style
+            row_num += 1
+
+        # Column Widths
+        ws.column('E').width = 40 # Process Desc
+        for col in range(8, current_col):
+            ws.column(col).width = 8
+
+        wb.save(path)
+    finally:
+        wb.close()
 
 # --- ENDPOINTS ---
 
@@ -260,33 +636,40 @@ async def analyze_file(
     """
     # Step 1: Calculate Takt Time & Suggestions for BOTH SMV and CT modes.
     """
-    content = await file.read()
-    sections_data = await parse_excel_structure(content)
+    file_key, sections_data = await parse_upload(file)
     
     if not sections_data:
         raise HTTPException(status_code=400, detail="No valid data found in Excel")
 
+    sec_names = list(sections_data.keys())
+
     # Helper function to calculate stats for a specific time mode (smv or ct)
+    # All sections are computed at once as NumPy arrays.
     def calculate_stats(mode_key):
-        total_mode = sum(sum(p[mode_key] for p in procs) for procs in sections_data.values())
+        sec_totals = np.fromiter(
+            (procs[f"{mode_key}_total"] for procs in sections_data.values()),
+            dtype=np.float64, count=len(sec_names)
+        )
+        total_mode = float(sec_totals.sum())
         takt_time_mode = total_mode / total_operators if total_operators > 0 else 0
         
-        results = []
-        for sec_name, procs in sections_data.items():
-            sec_total = sum(p[mode_key] for p in procs)
-            theoretical = sec_total / takt_time_mode if takt_time_mode > 0 else 0
-            suggested = max(1, round(theoretical))
-            
-            results.append({
+        theoretical = sec_totals / takt_time_mode if takt_time_mode > 0 else np.zeros_like(sec_totals)
+        suggested = np.maximum(1, np.round(theoretical)).astype(np.int64)
+        
+        results = [
+            {
                 "name": sec_name,
                 "total": round(sec_total, 2), # Total time for this section
-                "theoretical": round(theoretical, 2), 
-                "suggested": suggested 
-            })
+                "theoretical": round(theo, 2), 
+                "suggested": sugg 
+            }
+            for sec_name, sec_total, theo, sugg in zip(sec_names, sec_totals.tolist(), theoretical.tolist(), suggested.tolist())
+        ]
         return {"total_time": round(total_mode, 2), "takt_time": round(takt_time_mode, 2), "sections": results}
 
-    # Return both datasets so frontend can toggle
+    # Return both datasets so frontend can toggle, plus a token for /balance & /export
     return {
+        "token": create_session(file_key, sections_data),
         "smv_data": calculate_stats("smv"),
         "ct_data": calculate_stats("ct")
     }
@@ -296,28 +679,34 @@ async def balance_dynamic(
     config_str: str = Form(...), 
     time_mode: str = Form(...), # "smv" or "ct"
     selected_sections_str: str = Form("[]"), # JSON list of selected sections
-    file: UploadFile = File(...)
+    token: Optional[str] = Form(None), # From /analyze; replaces the file upload
+    file: Optional[UploadFile] = File(None)
 ):
     """
     Step 2: Balance based on time_mode, but calculate Efficiency for BOTH.
     """
     try:
-        config = json.loads(config_str) 
+        config = orjson.loads(config_str) 
     except:
         raise HTTPException(status_code=400, detail="Invalid configuration format")
 
-    content = await file.read()
-    sections_data = await parse_excel_structure(content)
+    file_key, sections_data = await load_sections(file, token)
+    
+    # 1. Balance using the SELECTED Mode (off the event loop, reused by /export)
+    # Each entry holds a simple list: [{"op": 1, "sec": 10.5, "tasks":...}]
+    balanced_sections = await get_balanced_sections(sections_data, config, time_mode, (file_key, config_str, time_mode))
     
     results_list = []
     all_ops_for_stats = []
+    op_sec_arrays = [] # op_sec of each section, same order as all_ops_for_stats
+    op_section_idx = [] # results_list index of each entry in all_ops_for_stats
+    global_total_smv = 0.0 # Global Totals, accumulated per section below
+    total_man_global = 0
     
-    for sec_name, procs in sections_data.items():
-        num_ops = int(config.get(sec_name, 1))
-        
-        # 1. Balance using the SELECTED Mode
-        # Returns simple list: [{"op": 1, "sec": 10.5, "tasks":...}]
-        balanced_ops_raw = true_thai_balancing(procs, num_ops, time_key=time_mode)
+    for balanced_sec, procs in zip(balanced_sections, sections_data.values()):
+        sec_name = balanced_sec["name"]
+        num_ops = balanced_sec["num_ops"]
+        balanced_ops_raw = balanced_sec["operators"]
         
         # Format "op" key to "Op 1", "Op 2" for display
         balanced_ops = []
@@ -327,11 +716,14 @@ async def balance_dynamic(
              balanced_ops.append(op_display)
 
         # 2. Calculate Totals for BOTH modes (for efficiency calc)
-        sec_total_smv = sum(p["smv"] for p in procs)
-        sec_total_ct = sum(p["ct"] for p in procs)
+        sec_total_smv = procs["smv_total"]
+        sec_total_ct = procs["ct_total"]
+        global_total_smv += sec_total_smv
+        total_man_global += len(balanced_ops)
         
         # 3. Find Bottleneck (based on the balanced result)
-        sec_bn = max((op["sec"] for op in balanced_ops), default=0)
+        op_sec = balanced_sec["op_sec"]
+        sec_bn = float(op_sec.max()) if op_sec.size else 0
 
         # 4. Calculate Metrics
         sec_output = round(3600 / sec_bn, 0) if sec_bn > 0 else 0
@@ -350,7 +742,7 @@ async def balance_dynamic(
         
         results_list.append({
             "name": sec_name,
-            "total_time_used": round(sum(p[time_mode] for p in procs), 2), 
+            "total_time_used": round(procs[f"{time_mode}_total"], 2), 
             "operators": balanced_ops,
             "section_bn": sec_bn,
             "sec_output": sec_output,
@@ -360,22 +752,24 @@ async def balance_dynamic(
         })
         
         all_ops_for_stats.extend(balanced_ops)
+        op_sec_arrays.append(op_sec)
+        op_section_idx.extend([len(results_list) - 1] * len(balanced_ops))
 
     # --- Global Analytics ---
-    all_times = [op["sec"] for op in all_ops_for_stats if op["sec"] > 0]
-    line_bottleneck = max(all_times) if all_times else 0
+    # all_ops_for_stats holds the same op dicts as results_list, so recoloring by index is enough
+    op_secs = np.concatenate(op_sec_arrays) if op_sec_arrays else np.zeros(0)
+    busy_secs = op_secs[op_secs > 0]
+    line_bottleneck = float(busy_secs.max()) if busy_secs.size else 0
     
-    # Update Red Color for Global Bottleneck
-    for section in results_list:
-        for op in section["operators"]:
-            if op["sec"] == line_bottleneck:
-                op["color"] = "red"
+    # Update Red Color for Global Bottleneck (every operator tied at the max)
+    bottleneck_idx = np.flatnonzero(op_secs == line_bottleneck).tolist()
+    for idx in bottleneck_idx:
+        all_ops_for_stats[idx]["color"] = "red"
     
-    total_man_global = sum(len(sec["operators"]) for sec in results_list)
-    global_denom = line_bottleneck * total_man_global
+    # Sections holding a bottleneck operator (= sections whose section_bn is the line bottleneck)
+    bn_sec_idx = dict.fromkeys(op_section_idx[idx] for idx in bottleneck_idx)
     
-    # Calculate Global Totals for both
-    global_total_smv = sum(sum(p["smv"] for p in procs) for procs in sections_data.values())
+    global_denom = line_bottleneck * total_man_global
     
     output = round(3600 / line_bottleneck, 0) if line_bottleneck > 0 else 0
     
@@ -388,7 +782,7 @@ async def balance_dynamic(
     selected_sections = []
     try:
         if 'selected_sections_str' in locals():
-             selected_sections = json.loads(selected_sections_str)
+             selected_sections = orjson.loads(selected_sections_str)
     except:
         selected_sections = []
 
@@ -398,10 +792,12 @@ async def balance_dynamic(
     # Get Cycle Times for Selected Sections
     # Cycle Time = Total Time Used / Num Ops
     
+    results_by_name = {r["name"]: r for r in results_list}
+    
     cycle_times = []
     for sec_name in selected_sections:
         # Find the result for this section
-        sec_res = next((r for r in results_list if r["name"] == sec_name), None)
+        sec_res = results_by_name.get(sec_name)
         if sec_res:
             # Re-calculate cycle time based on the Balanced output
             # Actually, "Cycle Time" per person is what we balanced. 
@@ -445,7 +841,7 @@ async def balance_dynamic(
         suggestions.append(f"✅ Excellent Line Balance ({line_balance_eff}%).")
     
     if line_bottleneck > 0:
-        bn_secs = [res["name"] for res in results_list if res["section_bn"] == line_bottleneck]
+        bn_secs = [results_list[i]["name"] for i in bn_sec_idx]
         # Clean naming for suggestion
         formatted_bn = [f"{s}" for s in bn_secs] 
         loc_str = " & ".join(formatted_bn)
@@ -454,42 +850,42 @@ async def balance_dynamic(
         if any("ass" in s.lower() for s in bn_secs):
              suggestions.append(f"👉 Action: Check Assembly machines.")
 
-    return {
+    # Returned as a Response directly so FastAPI skips jsonable_encoder on the nested payload
+    return ORJSONResponse({
         "bottleneck": round(line_bottleneck, 2),
         "output": output,
         "eff_smv": eff_smv_global,   
         "line_balance_eff": line_balance_eff,
         "suggest": " ".join(suggestions),
         "sections_results": results_list
-    }
+    })
 
 # --- NEW: EXPORT ENDPOINT ---
 @app.post("/export")
 async def export_excel(
     config_str: str = Form(...), 
     time_mode: str = Form(...), 
-    file: UploadFile = File(...)
+    token: Optional[str] = Form(None), # From /analyze; replaces the file upload
+    file: Optional[UploadFile] = File(None)
 ):
     try:
-        config = json.loads(config_str) 
+        config = orjson.loads(config_str) 
     except:
         raise HTTPException(status_code=400, detail="Invalid configuration format")
     
-    content = await file.read()
-    sections_data = await parse_excel_structure(content)
+    file_key, sections_data = await load_sections(file, token)
     
-    # 1. Run Balancing Logic (Internal - same as /balance)
-    balanced_results = []
-    for sec_name, procs in sections_data.items():
-        num_ops = int(config.get(sec_name, 1))
-        balanced_ops = true_thai_balancing(procs, num_ops, time_key=time_mode)
-        balanced_results.append({'name': sec_name, 'operators': balanced_ops})
+    # 1. Run Balancing Logic (Internal - same as /balance, reused if /balance already ran it)
+    # The report only needs task numbers and times, so skip building descriptions
+    balanced_results = await get_balanced_sections(sections_data, config, time_mode, (file_key, config_str, time_mode), build_desc=False)
     
     # 2. Generate Excel
-    excel_file = generate_excel_report(sections_data, balanced_results)
+    excel_path = await asyncio.to_thread(generate_excel_report, sections_data, balanced_results)
     
-    return StreamingResponse(
-        excel_file, 
+    # FileResponse streams straight from disk (sendfile where available)
+    return FileResponse(
+        excel_path, 
         media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", 
-        headers={"Content-Disposition": f"attachment; filename=Balancing_Report_{time_mode.upper()}.xlsx"}
+        headers={"Content-Disposition": f"attachment; filename=Balancing_Report_{time_mode.upper()}.xlsx"},
+        background=BackgroundTask(os.unlink, excel_path) # Removes the temp file once sent
     )
\ No newline at end of file